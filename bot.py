@@ -8,6 +8,7 @@ from todos import ToDoException
 
 from functools import wraps
 import os
+import time
 
 TOKEN = os.environ['DISCORD_TOKEN']
 
@@ -45,13 +46,13 @@ def catch_errors(command):
     return wrapper
 
 
-def parse_person(ctx, name:str):
+async def parse_person(ctx, name:str):
     if name:
-        person = todos.Person.from_name(name)
+        person = await todos.run_db(todos.Person.from_name, name)
         if not person:
             raise ToDoException(f"No person with name `{name}` is known. Add them using `/todo newperson`.")
     else:
-        person = todos.Person.from_id(str(ctx.author.id))
+        person = await todos.run_db(todos.Person.from_id, str(ctx.author.id))
         if not person:
             raise ToDoException(f"You are not yet known to the system. Use `/todo newperson` to get started.")
     return person
@@ -63,6 +64,7 @@ async def on_ready():
     print(bot.user.name)
     print(bot.user.id)
     print('------')
+    await todos.run_db(todos.warm_caches)
     update_reminders.start()
 
 
@@ -75,10 +77,10 @@ async def newperson(ctx,
                     ):
     if not id:
         id = str(ctx.author.id)
-        if existing_person:=todos.Person.from_id(id):
+        if existing_person:=await todos.run_db(todos.Person.from_id, id):
             raise ToDoException(f"Your id (`{id}`) is already known under the name {existing_person.pretty_name} (`{existing_person.name}`),\
                                     please provide a specific id for another person.")
-    person = todos.Person.new_person(name, pretty_name, id)
+    person = await todos.run_db(todos.Person.new_person, name, pretty_name, id)
     embed = discord.Embed(title="Created user", description=f"✅ Successfully initialized user {person.pretty_name} (<@{person.id}>)\
                             \nto refer to this user in commands, use `{person.name}`", color=GREEN)
     await ctx.respond(embed=embed, ephemeral=EPHEMERAL_MESSAGES)
@@ -91,8 +93,8 @@ async def todo_add(ctx,
                     name: Option(str, "The user whose list you want to add to (leave empty for your own list)", required = False, default=""),
                     deadline: Option(str, "The task's deadline (leave empty if there is none)", required = False, default="")
                     ):
-    person = parse_person(ctx, name)
-    task = person.add_task(task, deadline)
+    person = await parse_person(ctx, name)
+    task = await todos.run_db(person.add_task, task, deadline)
     embed = discord.Embed(title="Added task", description=f"✅ Successfully added the following task for **{person.pretty_name}**:\
                             \n>>> {task}", color=GREEN)
     await ctx.respond(embed=embed, ephemeral=EPHEMERAL_MESSAGES)
@@ -103,10 +105,10 @@ async def todo_add(ctx,
 async def todo_remove(ctx,
                     task_id: Option(int, "The numerical task id to remove", required = True),
                     ):
-    task = todos.Task.remove_task(task_id)
+    task = await todos.run_db(todos.Task.remove_task, task_id)
     if not task:
         raise ToDoException(f"There is no task with id `{task_id}`.")
-    person = todos.Person.from_name(task.name)
+    person = await todos.run_db(todos.Person.from_name, task.name)
     embed = discord.Embed(title="Removed task", description=f"✅ Marked the following task as completed (owned by **{person.pretty_name}**):\
                             \n>>> {task}", color=GREEN)
     await ctx.respond(embed=embed, ephemeral=EPHEMERAL_MESSAGES)
@@ -117,8 +119,8 @@ async def todo_remove(ctx,
 async def todo_list(ctx,
                     name: Option(str, "The user whose list you want to inspect (leave empty for your own list)", required = False, default=""),
                     ):
-    person = parse_person(ctx, name)
-    todo_list = person.todo_list()
+    person = await parse_person(ctx, name)
+    todo_list = await todos.run_db(person.todo_list)
     if not todo_list:
         todo_list = "Wow, such empty..."
     embed = discord.Embed(title=f"{person.pretty_name}'s to-do's", description=f">>> {todo_list}", color=GREEN)
@@ -136,10 +138,10 @@ async def reminder_add(ctx,
                     ):
     names = names.split(",")
     if names == [""] and not task_id:
-        person = parse_person(ctx, None)
+        person = await parse_person(ctx, None)
         names = [person.name]
-    reminder = todos.Reminder.new_reminder(time, names, recurring, content, task_id)
-    people = [todos.Person.from_name(name).pretty_name for name in reminder.names]
+    reminder = await todos.run_db(todos.Reminder.new_reminder, time, names, recurring, content, task_id)
+    people = [(await todos.run_db(todos.Person.from_name, name)).pretty_name for name in reminder.names]
     people_str = ", ".join(people)
     embed = discord.Embed(title="Added task", description=f"✅ Successfully created the following reminder for **{people_str}** :\
                             \n>>> {reminder}", color=GREEN)
@@ -151,10 +153,10 @@ async def reminder_add(ctx,
 async def reminder_remove(ctx,
                     reminder_id: Option(int, "The numerical reminder id to remove", required = True),
                     ):
-    reminder = todos.Reminder.remove_reminder(reminder_id)
+    reminder = await todos.run_db(todos.Reminder.remove_reminder, reminder_id)
     if not reminder:
         raise ToDoException(f"There is no reminder with id `{reminder_id}`.")
-    people = [todos.Person.from_name(name).pretty_name for name in reminder.names]
+    people = [(await todos.run_db(todos.Person.from_name, name)).pretty_name for name in reminder.names]
     people_str = ", ".join(people)
     embed = discord.Embed(title="Removed task", description=f"✅ Removed the following reminder for **{people_str}**:\
                             \n>>> {reminder}", color=GREEN)
@@ -166,8 +168,8 @@ async def reminder_remove(ctx,
 async def reminder_list(ctx,
                     name: Option(str, "The user whose list you want to inspect (leave empty for your own list)", required = False, default=""),
                     ):
-    person = parse_person(ctx, name)
-    reminder_list = person.reminder_list()
+    person = await parse_person(ctx, name)
+    reminder_list = await todos.run_db(person.reminder_list)
     if not reminder_list:
         reminder_list = "Wow, such empty..."
     embed = discord.Embed(title=f"{person.pretty_name}'s reminders (some may be shared with other people)", description=f">>> {reminder_list}", color=GREEN)
@@ -175,15 +177,62 @@ async def reminder_list(ctx,
 
 
 
+_dm_channels: dict[str, discord.DMChannel] = {} # keyed by user id
+
+# bounds the number of DMs in flight, so a large batch of reminders backs off instead of running into rate limits
+_send_limit = asyncio.Semaphore(20)
+
+
+async def dm_channel(user_id:str) -> discord.DMChannel:
+    """ Returns the DM channel with a user, only going through the Discord API the first time """
+    if channel := _dm_channels.get(user_id):
+        return channel
+    user = bot.get_user(int(user_id)) or await bot.fetch_user(int(user_id))
+    channel = user.dm_channel or await user.create_dm()
+    _dm_channels[user_id] = channel
+    return channel
+
+
+def batch_embeds(embeds:list[discord.Embed]) -> list[list[discord.Embed]]:
+    """ Splits embeds into batches that fit in one message: at most 10 embeds, with at most 6000 characters in total """
+    batches = []
+    for embed in embeds:
+        if batches and len(batches[-1]) < 10 and sum(map(len, batches[-1])) + len(embed) <= 6000:
+            batches[-1].append(embed)
+        else:
+            batches.append([embed])
+    return batches
+
+
+async def notify(user_id:str, embeds:list[discord.Embed]):
+    async with _send_limit:
+        channel = await dm_channel(user_id)
+        for batch in batch_embeds(embeds):
+            await channel.send(embeds=batch)
+
+
 @tasks.loop(seconds=60)
 async def update_reminders():
-    reminders_to_show = todos.Reminder.update_reminders()
+    reminders_to_show = await todos.run_db(todos.Reminder.update_reminders)
+    embeds = {} # grouped by user id, so everyone gets all of their reminders in a single DM
     for reminder in reminders_to_show:
         embed = discord.Embed(title="Reminder", description=str(reminder), color=BROWN)
         for name in reminder.names:
-            person = todos.Person.from_name(name)
-            user = await bot.fetch_user(person.id)
-            await user.send(embed=embed)
+            person = await todos.run_db(todos.Person.from_name, name)
+            embeds.setdefault(person.id, []).append(embed)
+    # all DMs are sent concurrently, one failing doesn't stop the others from being delivered
+    results = await asyncio.gather(*[notify(user_id, user_embeds) for user_id, user_embeds in embeds.items()],
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Failed to send a reminder: {result!r}")
+
+    # wake up right when the next reminder is due, but at least every minute to pick up newly added reminders
+    next_deadline = await todos.run_db(todos.Reminder.next_deadline)
+    if next_deadline is None:
+        update_reminders.change_interval(seconds=60)
+    else:
+        update_reminders.change_interval(seconds=min(max(next_deadline - time.time(), 1), 60))
 
 
 
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+
+NUM_BUCKETS = 4096
+TICK_SECONDS = 60
+
+
+class WheelTimer:
+    """ A hierarchical timing wheel mapping keys (reminder doc_ids) to the unix timestamp at which they expire.
+
+    The fine wheel has `num_buckets` buckets of `tick_seconds` each, the coarse wheel has `num_buckets` buckets
+    spanning a full rotation of the fine wheel each. Deadlines beyond the coarse wheel wait in an overflow list.
+    Polling only touches the buckets the clock has moved past, so its cost scales with the number of expired
+    entries rather than the total number of scheduled ones.
+
+    Cancelling is done by bumping the key's generation: entries carrying an older generation are dropped
+    when their bucket is reached, so no bucket ever has to be searched. """
+
+    def __init__(self, now:int, num_buckets:int=NUM_BUCKETS, tick_seconds:int=TICK_SECONDS):
+        self.num_buckets = num_buckets
+        self.tick_seconds = tick_seconds
+        self.fine: list[list[tuple]] = [[] for _ in range(num_buckets)]
+        self.coarse: list[list[tuple]] = [[] for _ in range(num_buckets)]
+        self.overflow: list[tuple] = []
+        self.current_tick = now // tick_seconds # the next tick that has not been fully drained yet
+        self.timer_generation: dict[int, int] = {}
+        self._next_deadline: int | None = None # a lower bound for the earliest deadline, None if nothing is scheduled
+        self._next_deadline_known = True # False when `_next_deadline` has to be looked up again
+
+    def schedule(self, key:int, deadline:int):
+        """ (Re)schedules `key` to expire at `deadline`, replacing any earlier schedule for it """
+        generation = self.timer_generation.get(key, 0) + 1
+        self.timer_generation[key] = generation
+        self._insert((deadline, key, generation))
+        if self._next_deadline_known and (self._next_deadline is None or deadline < self._next_deadline):
+            self._next_deadline = deadline
+
+    def cancel(self, key:int):
+        """ Makes sure `key` won't expire, without looking for it in the buckets """
+        if key in self.timer_generation:
+            self.timer_generation[key] += 1
+
+    def poll_expired(self, now:int) -> list[int]:
+        """ Returns the keys whose deadline is at or before `now`, removing them from the wheel """
+        now_tick = now // self.tick_seconds
+        expired = []
+        while self.current_tick < now_tick:
+            index = self.current_tick % self.num_buckets
+            expired.extend(key for _, key, generation in self.fine[index] if self._is_live(key, generation))
+            self.fine[index] = []
+            self.current_tick += 1
+            if self.current_tick % self.num_buckets == 0:
+                self._cascade()
+
+        # the current tick is only partially over, so keep what hasn't expired yet
+        index = self.current_tick % self.num_buckets
+        remaining = []
+        for entry in self.fine[index]:
+            deadline, key, generation = entry
+            if not self._is_live(key, generation):
+                continue
+            if deadline <= now:
+                expired.append(key)
+            else:
+                remaining.append(entry)
+        self.fine[index] = remaining
+        if self._next_deadline is not None and now >= self._next_deadline:
+            # whatever was due has expired, or was cancelled, so the next deadline is a later one
+            self._next_deadline_known = False
+        return expired
+
+    def next_deadline(self) -> int | None:
+        """ Returns a time before which nothing will expire (the earliest deadline, unless it was cancelled),
+        or None if nothing is scheduled. Only the buckets up to the first non-empty one are looked at. """
+        if not self._next_deadline_known:
+            self._next_deadline = self._find_next_deadline()
+            self._next_deadline_known = True
+        return self._next_deadline
+
+    def _find_next_deadline(self) -> int | None:
+        n = self.num_buckets
+        rotation = self.current_tick // n
+        # the rest of this rotation is only ever in the fine wheel, so anything there comes first
+        for tick in range(self.current_tick, (rotation + 1) * n):
+            if bucket := self._live(self.fine[tick % n]):
+                return min(deadline for deadline, _, _ in bucket)
+        # the next rotation may be spread over both wheels, and overflow entries can be due before coarse ones
+        candidates = []
+        for tick in range((rotation + 1) * n, self.current_tick + n):
+            if bucket := self._live(self.fine[tick % n]):
+                candidates.append(min(deadline for deadline, _, _ in bucket))
+                break
+        for offset in range(1, n):
+            if bucket := self._live(self.coarse[(rotation + offset) % n]):
+                candidates.append(min(deadline for deadline, _, _ in bucket))
+                break
+        if bucket := self._live(self.overflow):
+            candidates.append(min(deadline for deadline, _, _ in bucket))
+        return min(candidates, default=None)
+
+    def _live(self, entries:list[tuple]) -> list[tuple]:
+        return [entry for entry in entries if self._is_live(entry[1], entry[2])]
+
+    def _is_live(self, key:int, generation:int) -> bool:
+        return self.timer_generation.get(key) == generation
+
+    def _insert(self, entry:tuple):
+        deadline_tick = max(entry[0] // self.tick_seconds, self.current_tick)
+        if deadline_tick - self.current_tick < self.num_buckets:
+            self.fine[deadline_tick % self.num_buckets].append(entry)
+            return
+        rotation = deadline_tick // self.num_buckets
+        if rotation - self.current_tick // self.num_buckets < self.num_buckets:
+            self.coarse[rotation % self.num_buckets].append(entry)
+        else:
+            self.overflow.append(entry)
+
+    def _cascade(self):
+        """ Called when the fine wheel starts a new rotation: moves the entries due during it down from the coarse wheel """
+        rotation = self.current_tick // self.num_buckets
+        index = rotation % self.num_buckets
+        entries, self.coarse[index] = self.coarse[index], []
+        if index == 0:
+            entries += self.overflow
+            self.overflow = []
+        for entry in entries:
+            if self._is_live(entry[1], entry[2]):
+                self._insert(entry)
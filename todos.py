@@ -2,11 +2,25 @@ from __future__ import annotations
 
 from tinydb import TinyDB, Query, Storage
 import yaml
+try: # libyaml is a lot faster, but isn't available everywhere
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+from timing_wheel import WheelTimer
 
 import dateutil.parser
+import dateutil.relativedelta
 import datetime
 import pytz
 
+import asyncio
+import atexit
+import contextlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 
 class ToDoException(Exception):
     """ An exception that when raised will show a detailed message to the reminders.remove(Query().task == task_id)user """
@@ -17,6 +31,7 @@ class ToDoException(Exception):
         return f"ToDoException: {self.msg}"
 
 
+@functools.lru_cache(maxsize=4096)
 def format_name(name:str):
     """ Defines the format `name` fields in the database must adhere to """
     return name.strip().lower().replace(" ", "_")
@@ -26,13 +41,30 @@ DATE_FMT = "%Y-%m-%d"
 TIME_FMT = "%Y-%m-%d %X"
 TIMEZONE = "Europe/Brussels"
 
+_TZ = pytz.timezone(TIMEZONE)
+
 PARSERINFO = dateutil.parser.parserinfo(dayfirst=True)
 
+# the formats written to the database and the one users are asked for, these are parsed without dateutil
+_FAST_FORMATS = (TIME_FMT, "%Y-%m-%d %H:%M", DATE_FMT)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_dt(time:str) -> datetime.datetime | None:
+    """ Parses a time in one of the `_FAST_FORMATS`, returns None for anything else.
+    Other strings are left to dateutil and not cached, since it fills in missing fields relative to today. """
+    for format in _FAST_FORMATS:
+        try:
+            return datetime.datetime.strptime(time, format).astimezone(_TZ)
+        except ValueError:
+            pass
+    return None
+
 
 def datetime_from_string(time:str, format=None):
     """ Determines a datetime from a string. If a format is passed, the datetime is formatted into a string again. """
     try:
-        dt = dateutil.parser.parse(time, PARSERINFO).astimezone(pytz.timezone(TIMEZONE))
+        dt = _parse_dt(time) or dateutil.parser.parse(time, PARSERINFO).astimezone(_TZ)
         if format:
             return dt.strftime(format)
         else:
@@ -41,39 +73,123 @@ def datetime_from_string(time:str, format=None):
         raise ToDoException(f"Was unable to parse the string `{time}` as a time. To be sure, format times as `yyyy-mm-dd hh:mm`,\
                              but most English-language strings should be fine.")
 
-def timestamp_from_string(time:str):
-    try:
-        dt = dateutil.parser.parse(time).astimezone(pytz.timezone("Europe/Brussels"))
-        return int(datetime.datetime.timestamp(dt))
-    except dateutil.parser.ParserError as e:
-        raise ToDoException(f"Was unable to parse the string `{time}` as a time. To be sure, format times as `yyyy-mm-dd hh:mm`,\
-                             but most English-language strings should be fine.")
+def epoch_from_string(time:str):
+    """ Converts a time as reminders used to store it (`TIME_FMT`, local to `TIMEZONE`) into a unix timestamp """
+    dt = _TZ.localize(datetime.datetime.strptime(time, TIME_FMT))
+    return int(dt.timestamp())
+
+
+# TinyDB is not thread-safe, so all database work happens on this single thread.
+# This keeps the bot's event loop responsive while the (blocking) database is busy.
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """ Runs a blocking function that uses the database on the database thread, and waits for its result """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def next_occurrence(time:datetime.datetime, recurring:str, now:datetime.datetime) -> datetime.datetime:
+    """ Returns the first time after `now` that lies a whole number of `recurring` periods from `time` """
+    if recurring in ("daily", "weekly"):
+        period = datetime.timedelta(days=1 if recurring == "daily" else 7)
+        periods = max((now - time) // period + 1, 0)
+        return time + periods * period
+    if recurring == "monthly":
+        months = (now.year - time.year) * 12 + now.month - time.month
+        step = dateutil.relativedelta.relativedelta(months=1)
+    else:
+        months = now.year - time.year
+        step = dateutil.relativedelta.relativedelta(years=1)
+    # always counted from the original time, so e.g. the 31st doesn't drift to the 28th after February
+    next_time = time + max(months, 0) * step
+    if next_time <= now:
+        next_time = time + (max(months, 0) + 1) * step
+    return next_time
+
 
 
 class YAMLStorage(Storage):
+    """ Keeps the parsed database in memory. Writes update that copy straight away and are flushed to disk
+    shortly after, so that a burst of writes (as most commands make) results in a single dump.
+    The file is only read once, at startup: the running bot owns it, so stop the bot before editing it by hand. """
+
+    FLUSH_DELAY = 0.5 # seconds
+
     def __init__(self, filename):
         self.filename = filename
         with open(filename, 'a'): # creates the file if it doesn't exist
             pass
-
-    def read(self):
-        with open(self.filename) as handle:
+        self._flush_timer = None
+        self._dirty = False # whether there are writes that haven't been flushed yet
+        self._batch_depth = 0
+        with open(filename) as handle:
             try:
-                data = yaml.safe_load(handle.read())
-                return data
+                self._data = yaml.load(handle, Loader=SafeLoader)
             except yaml.YAMLError:
-                return None
+                self._data = None
+
+    def read(self):
+        return self._data
 
     def write(self, data):
+        self._data = data
+        self._dirty = True
+        if not self._batch_depth:
+            self._schedule_flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Holds back flushing until the end of the block, so all writes made in it end up in a single flush """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._dirty:
+                self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_timer:
+            return # a flush is already on its way
+        # the flush itself is queued on the database thread, so it never races with TinyDB modifying the data
+        self._flush_timer = threading.Timer(self.FLUSH_DELAY, _db_executor.submit, (self._flush,))
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def _flush(self):
+        if self._flush_timer:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._dirty = False
         with open(self.filename, 'w+') as handle:
-            yaml.dump(data, handle)
+            yaml.dump(self._data, handle, Dumper=SafeDumper)
 
     def close(self):
-        pass
+        if self._dirty:
+            self._flush()
 
 # /app/data is the persistent volume provided by docker/podman
 # if you want to run this outside of a container, just use "db.json"
 db = TinyDB("/app/data/db.yml", storage=YAMLStorage)
+atexit.register(db.close) # flushes any pending write
+
+
+def db_transaction():
+    """ Groups the database writes made inside the `with` block into a single flush to disk.
+    This does not make them atomic: each write still takes effect in memory immediately. """
+    return db.storage.batch()
+
+
+# queries are built once here rather than on every lookup
+_Q = Query()
+_Q_NAME = _Q.name
+_Q_ID = _Q.id
+
+
+# people are looked up on nearly every command but hardly ever change, so they are memoized here.
+# Person.new_person and Person.remove_person keep these coherent with the database.
+_by_name: dict[str, Person] = {}
+_by_id: dict[str, Person] = {}
 
 
 class Person:
@@ -92,19 +208,29 @@ class Person:
     @classmethod
     def from_name(cls, name:str) -> Person:
         name = format_name(name)
-        _person = cls.table.get(Query().name == name)
+        if name in _by_name:
+            return _by_name[name]
+        _person = cls.table.get(_Q_NAME == name)
         if _person:
-            return cls(_person)
+            return cls._remember(cls(_person))
         else:
             return None
     
     @classmethod
     def from_id(cls, id:str) -> Person:
-        _person = cls.table.get(Query().id == id)
+        if id in _by_id:
+            return _by_id[id]
+        _person = cls.table.get(_Q_ID == id)
         if _person:
-            return cls(_person)
+            return cls._remember(cls(_person))
         else:
             return None
+
+    @staticmethod
+    def _remember(person:Person) -> Person:
+        _by_name[person.name] = person
+        _by_id[person.id] = person
+        return person
     
     @classmethod
     def new_person(cls, name:str, pretty_name:str, id:str) -> Person:
@@ -114,15 +240,17 @@ class Person:
         if cls.from_id(id):
             raise ToDoException(f"A person with id `{id}` already exists.")
         doc_id = cls.table.insert({'name': name, 'pretty_name': pretty_name, 'id': id})
-        return cls(cls.table.get(doc_id=doc_id))
+        return cls._remember(cls(cls.table.get(doc_id=doc_id)))
     
     @classmethod
     def remove_person(cls, name:str):
         name = format_name(name)
-        cls.table.remove(Query().name == name)
-        for task in Task.table.search(Query().name == name):
-            Reminder.table.remove(Query().name == name)
-            Task.remove_task(task.doc_id)
+        if person := _by_name.pop(name, None):
+            _by_id.pop(person.id, None)
+        with db_transaction():
+            cls.table.remove(_Q_NAME == name)
+            for task_id in list(Task.by_person().get(name, ())):
+                Task.remove_task(task_id) # this also removes the task's reminders
     
     def add_task(self, content, deadline:str=None) -> Task:
         if not content:
@@ -132,29 +260,24 @@ class Person:
             task_id = Task.table.insert({'name': self.name, 'content': content, 'deadline': deadline})
         else:
             task_id = Task.table.insert({'name': self.name, 'content': content})
+        Task.by_person().setdefault(self.name, set()).add(task_id)
         return Task.from_id(task_id)
 
     def todos(self):
         return [
-            Task(_task) for _task in Task.table.search(Query().name == self.name)
+            Task.from_id(task_id) for task_id in sorted(Task.by_person().get(self.name, ()))
         ]
 
     def todo_list(self) -> str:
-        _todo_list = ""
-        for task in self.todos():
-            _todo_list += str(task) + "\n"
-        return _todo_list
+        return "".join(f"{task}\n" for task in self.todos())
 
     def reminders(self):
         return [
-            Reminder(_reminder) for _reminder in Reminder.table.search(Query().names.any([self.name]))
+            Reminder.from_id(reminder_id) for reminder_id in sorted(Reminder.by_person().get(self.name, ()))
         ]
 
     def reminder_list(self) -> str:
-        _reminder_list = ""
-        for reminder in self.reminders():
-            _reminder_list += str(reminder) + "\n"
-        return _reminder_list
+        return "".join(f"{reminder}\n" for reminder in self.reminders())
 
 
 class Task:
@@ -163,6 +286,8 @@ class Task:
     name: str # the person to whom the task belongs (format: all lowercase)
     content: str # the task content
     deadline : str | None # [optional] the date by which the task should be completed at the latest (format: yyyy-mm-dd)
+
+    _by_person: dict[str, set[int]] = None # the doc_ids of each person's tasks, loaded on first use
     
     def __init__(self, _task):
         self.doc_id = _task.doc_id
@@ -183,20 +308,32 @@ class Task:
             return cls(_task)
         else:
             return None
+
+    @classmethod
+    def by_person(cls) -> dict[str, set[int]]:
+        """ Returns the doc_ids of each person's tasks, loading them from the database the first time """
+        if cls._by_person is None:
+            cls._by_person = {}
+            for _task in cls.table.all():
+                cls._by_person.setdefault(_task['name'], set()).add(_task.doc_id)
+        return cls._by_person
     
     @classmethod
     def remove_task(cls, task_id:int) -> Task:
         task = cls.from_id(task_id)
         if task:
-            Task.table.remove(doc_ids=[task_id])
-            Reminder.table.remove(Query().task == task_id)
+            with db_transaction():
+                Task.table.remove(doc_ids=[task_id])
+                Task.by_person().get(task.name, set()).discard(task_id)
+                for reminder_id in list(Reminder.by_task().get(task_id, ())):
+                    Reminder.remove_reminder(reminder_id)
         return task
 
 
 class Reminder:
     table = db.table('reminders')
 
-    time: str # the date to post the reminder (format: yyyy-mm-dd)
+    time: int # the moment to post the reminder (format: unix timestamp)
     names : list[str] # people to remind
     recurring : str # must be 'daily', 'weekly', or 'monthly', other values will be interpreted as 'off'
     content : str # what to remind the person of (copied from the task by default)
@@ -204,6 +341,10 @@ class Reminder:
 
     recurring_options = ("daily", "weekly", "monthly", "yearly")
 
+    _timer: WheelTimer = None # schedules reminders by doc_id, loaded on first use
+    _by_task: dict[int, set[int]] = None # the doc_ids of the reminders linked to each task, loaded on first use
+    _by_person: dict[str, set[int]] = None # the doc_ids of the reminders for each person, loaded on first use
+
     def __init__(self, _reminder):
         self.doc_id = _reminder.doc_id
         self.time = _reminder['time']
@@ -213,8 +354,7 @@ class Reminder:
         self.task_id = _reminder['task_id'] if 'task_id' in _reminder else None
     
     def __str__(self):
-        timestamp = timestamp_from_string(self.time)
-        _str = f"**[{self.doc_id}]** {self.content} [<t:{timestamp}:R>]"
+        _str = f"**[{self.doc_id}]** {self.content} [<t:{self.time}:R>]"
         if self.recurring in Reminder.recurring_options:
             _str += f" *(recurring {self.recurring})*"
         if self.task_id:
@@ -228,6 +368,36 @@ class Reminder:
             return cls(_reminder)
         else:
             return None
+
+    @classmethod
+    def timer(cls) -> WheelTimer:
+        """ Returns the timing wheel holding every reminder, loading it from the database the first time """
+        if cls._timer is None:
+            now = int(datetime.datetime.now(_TZ).timestamp())
+            cls._timer = WheelTimer(now)
+            for _reminder in cls.table.all(): # raw rows, there's no need to build a Reminder just to read its time
+                cls._timer.schedule(_reminder.doc_id, _reminder['time'])
+        return cls._timer
+
+    @classmethod
+    def by_task(cls) -> dict[int, set[int]]:
+        """ Returns the doc_ids of the reminders linked to each task, loading them from the database the first time """
+        if cls._by_task is None:
+            cls._by_task = {}
+            for _reminder in cls.table.all():
+                if 'task_id' in _reminder:
+                    cls._by_task.setdefault(_reminder['task_id'], set()).add(_reminder.doc_id)
+        return cls._by_task
+
+    @classmethod
+    def by_person(cls) -> dict[str, set[int]]:
+        """ Returns the doc_ids of the reminders for each person, loading them from the database the first time """
+        if cls._by_person is None:
+            cls._by_person = {}
+            for _reminder in cls.table.all():
+                for name in _reminder['names']:
+                    cls._by_person.setdefault(name, set()).add(_reminder.doc_id)
+        return cls._by_person
     
     @classmethod
     def new_reminder(cls, time:str, names:list[str], recurring:str, content:str, task_id:str) -> Reminder:
@@ -243,7 +413,7 @@ class Reminder:
             if not content:
                 content = task.content
         if time:
-            time = datetime_from_string(time, format=TIME_FMT)
+            time = int(datetime_from_string(time).timestamp())
         for name in names:
             person = Person.from_name(name)
             if name and not person:
@@ -265,6 +435,11 @@ class Reminder:
         if task_id:
             _reminder['task_id'] = task_id
         reminder_id = Reminder.table.insert(_reminder)
+        Reminder.timer().schedule(reminder_id, time)
+        if task_id:
+            Reminder.by_task().setdefault(task_id, set()).add(reminder_id)
+        for name in names:
+            Reminder.by_person().setdefault(name, set()).add(reminder_id)
         return Reminder.from_id(reminder_id)
 
     @classmethod
@@ -272,43 +447,77 @@ class Reminder:
         reminder = cls.from_id(reminder_id)
         if reminder:
             Reminder.table.remove(doc_ids=[reminder_id])
+            Reminder.timer().cancel(reminder_id)
+            if reminder.task_id:
+                Reminder.by_task().get(reminder.task_id, set()).discard(reminder_id)
+            for name in reminder.names:
+                Reminder.by_person().get(name, set()).discard(reminder_id)
         return reminder
 
+    @classmethod
+    def next_deadline(cls) -> int | None:
+        """ Returns the unix timestamp before which no reminder is due, or None if there are no reminders """
+        return cls.timer().next_deadline()
+
+    @classmethod
+    def due(cls, before:int, limit:int=1000) -> list:
+        """ Takes the reminders due at `before` off the timer and returns their raw rows, earliest first.
+        Anything over `limit` is put back, to be returned by the next call. """
+        rows = [cls.table.get(doc_id=reminder_id) for reminder_id in cls.timer().poll_expired(before)]
+        # reminders removed without going through `remove_reminder` may still have been in the timer
+        rows = sorted((row for row in rows if row), key=lambda row: row['time'])
+        for row in rows[limit:]:
+            cls.timer().schedule(row.doc_id, row['time'])
+        return rows[:limit]
+
     @classmethod
     def update_reminders(cls):
         """ This function checks if any reminders have gone off, returns them,
         and either removes them from the database or resets their timer. """
-        reminders = [cls(_reminder) for _reminder in cls.table.all()]
         reminders_to_show = []
-        dt_now = datetime.datetime.now(pytz.timezone("Europe/Brussels"))
-        now = dt_now.strftime(TIME_FMT)
-        for reminder in reminders:
-            if reminder.time < now:
+        dt_now = datetime.datetime.now(_TZ)
+        next_deadline = cls.next_deadline()
+        if next_deadline is None or dt_now.timestamp() < next_deadline:
+            return reminders_to_show # nothing is due yet, so there's no need to touch the database
+        with db_transaction():
+            for _reminder in cls.due(int(dt_now.timestamp())):
+                reminder = cls(_reminder)
                 reminders_to_show.append(reminder)
 
-                next_time = datetime_from_string(reminder.time)
-                if reminder.recurring == 'daily':
-                    while next_time < dt_now:
-                        next_time += datetime.timedelta(days=1)
-                elif reminder.recurring == 'weekly':
-                    while next_time < dt_now:
-                        next_time += datetime.timedelta(days=7)
-                elif reminder.recurring == 'monthly':
-                    while next_time < dt_now:
-                        next_time += datetime.timedelta(days=1)
-                elif reminder.recurring == 'yearly':
-                    while next_time < dt_now:
-                        next_time += datetime.timedelta(days=1)
-                else:
+                if reminder.recurring not in Reminder.recurring_options:
                     # this reminder isn't recurring, it can just be deleted
                     cls.remove_reminder(reminder.doc_id)
                     continue
-                 
-                reminder.set_new_time(next_time.strftime(TIME_FMT))
+
+                # recurrence is counted in wall-clock time, so reminders keep their hour across DST changes
+                wall_time = datetime.datetime.fromtimestamp(reminder.time, _TZ).replace(tzinfo=None)
+                next_time = next_occurrence(wall_time, reminder.recurring, dt_now.replace(tzinfo=None))
+                reminder.set_new_time(int(_TZ.localize(next_time).timestamp()))
 
         return reminders_to_show
                 
-    def set_new_time(self, time:str):
-        time = datetime_from_string(time, TIME_FMT)
+    def set_new_time(self, time:int):
         self.time = time
-        self.table.update({'time': time}, doc_ids=[self.doc_id])
\ No newline at end of file
+        self.table.update({'time': time}, doc_ids=[self.doc_id])
+        Reminder.timer().schedule(self.doc_id, time)
+
+    @classmethod
+    def migrate_times(cls):
+        """ Reminders used to store their time as a `TIME_FMT` string, this converts those to unix timestamps """
+        with db_transaction():
+            for _reminder in cls.table.all():
+                if isinstance(_reminder['time'], str):
+                    cls.table.update({'time': epoch_from_string(_reminder['time'])}, doc_ids=[_reminder.doc_id])
+
+
+Reminder.migrate_times()
+
+
+def warm_caches():
+    """ Loads the people cache and the task and reminder indexes in one go, so the first commands don't have to """
+    for _person in Person.table.all():
+        Person._remember(Person(_person))
+    Task.by_person()
+    Reminder.timer()
+    Reminder.by_task()
+    Reminder.by_person()
\ No newline at end of file